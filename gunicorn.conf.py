@@ -0,0 +1,27 @@
+"""
+Gunicorn settings for serving server.py.
+
+The app spends nearly all of its time waiting on Google APIs, so gevent workers
+let each process handle many requests concurrently. Run with:
+
+    gunicorn server:app
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+worker_class = "gevent"
+workers = int(os.environ.get("GUNICORN_WORKERS", 2))
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 1000))
+
+
+def post_worker_init(worker):  # pylint: disable=unused-argument
+    """
+    Make gRPC, used by the Cloud Scheduler client, cooperate with gevent.
+
+    This must run after the gevent worker has monkey-patched the standard library,
+    which happens after post_fork, and before any gRPC client is created.
+    """
+    from grpc.experimental import gevent as grpc_gevent  # pylint: disable=import-outside-toplevel
+
+    grpc_gevent.init_gevent()
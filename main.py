@@ -3,29 +3,83 @@ Manage user access by temporarily switching their Organizational Unit (OU) to a
 """
 
 import os
+import gzip
 import json
 import logging
-from datetime import datetime, timedelta, time
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
 # Grouped google imports
 from google.api_core.exceptions import (
+    AlreadyExists,
     GoogleAPICallError,
     RetryError,
     NotFound,
     PermissionDenied,
+    PreconditionFailed,
     ServiceUnavailable,
 )
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import scheduler_v1, storage
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
 
 # Other third-party import
 from flask import jsonify
-from croniter import croniter
+from requests import RequestException
+from requests.adapters import HTTPAdapter
+import orjson
 
 storage_client = storage.Client()
 
+
+class UserDataCache(threading.local):
+    """
+    Dict-like holder for the user data of the request being handled.
+
+    Each thread, or each greenlet when served by gevent workers, sees its own
+    contents, so concurrent requests never share cached user data.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.reset()
+
+    def __getitem__(self, key):
+        return self.__dict__[key]
+
+    def __setitem__(self, key, value):
+        self.__dict__[key] = value
+
+    def update(self, values):
+        """Set several cache entries at once."""
+        self.__dict__.update(values)
+
+    def reset(self):
+        """Discard all cached entries."""
+        self.update(
+            {
+                "data": None,
+                "raw": None,
+                "generation": None,
+                "dirty": set(),
+                "from_snapshot": False,
+            }
+        )
+
+
+# User data read from GCS, kept for the duration of a request and written back
+# once by flush_data_to_gcs(). "raw" is the blob content as read, "dirty" holds
+# the emails whose records were changed since then and "from_snapshot" tells whether
+# the data came from _gcs_snapshot rather than a fresh download.
+_cache = UserDataCache()
+
+# The blob content most recently read from or written to GCS by this instance, as
+# (time.monotonic() when stored, raw bytes, generation). Shared by all requests so
+# back-to-back invocations on a warm instance can skip the download.
+_gcs_snapshot = None
+
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -56,37 +110,82 @@ except KeyError as key_error:
     raise RuntimeError(f"Missing environment variable: {key_error}") from key_error
 
 SCOPES = ["https://www.googleapis.com/auth/admin.directory.user"]
+DIRECTORY_USERS_URL = "https://admin.googleapis.com/admin/directory/v1/users"
+
+# Cloud Scheduler names and payload for USER_EMAIL's revert job
+SANITIZED_EMAIL = USER_EMAIL.replace("@", "_").replace(".", "_")
+PARENT_PATH = f"projects/{PROJECT_ID}/locations/{LOCATION}"
+JOB_NAME = f"{PARENT_PATH}/jobs/{SANITIZED_EMAIL}_revert_ou"
+REVERT_JOB_BODY = json.dumps({"email": USER_EMAIL}).encode("utf-8")
+
+# How many times to try writing user data when the blob was changed concurrently.
+GCS_WRITE_ATTEMPTS = 3
+
+# How long a downloaded blob is reused by later requests on the same instance.
+GCS_CACHE_TTL_SECONDS = 5
+
+# How many times to try scheduling the revert job, and the delay before the first
+# retry. The delay doubles after each failed attempt.
+REVERT_JOB_ATTEMPTS = 4
+REVERT_JOB_RETRY_DELAY_SECONDS = 2
+
+# Parts of user messages that only depend on configuration
+_LIMIT_SWITCHES_WORD = "switch" if UNRESTRICTED_SWITCH_LIMIT == 1 else "switches"
+_LIMIT_PREFIX = (
+    f"You've reached the maximum of {UNRESTRICTED_SWITCH_LIMIT} {_LIMIT_SWITCHES_WORD} "
+    "into a less restrictive organizational unit today."
+)
+_DURATION_PHRASE = f"{DURATION_MINUTES} minutes"
+
+# The Directory API session is created once per instance and reused by warm invocations,
+# keeping its connections and access token alive between requests.
+_service_singleton = None
+_service_lock = threading.Lock()
+
+# Runs work the response doesn't depend on, such as scheduling the revert job.
+_background_pool = ThreadPoolExecutor(max_workers=2)
 
 
 # Get Google Service
 def get_google_service():
-    """Return Google service object after authenticating using service account and admin email."""
+    """
+    Return an authorized HTTP session for the Directory API, authenticating using the
+    service account and admin email.
+    """
+    global _service_singleton  # pylint: disable=global-statement
+
+    if _service_singleton is not None:
+        return _service_singleton
+
     try:
-        logger.info("Fetching Google service object.")
+        with _service_lock:
+            # Another thread may have built the service while we waited for the lock
+            if _service_singleton is not None:
+                return _service_singleton
 
-        # Ensure the environment variable is set
-        if "GOOGLE_APPLICATION_CREDENTIALS" not in os.environ:
-            raise ValueError(
-                "Environment variable GOOGLE_APPLICATION_CREDENTIALS is not set."
-            )
+            logger.info("Creating Google Directory API session.")
 
-        # Load service account credentials
-        credentials = service_account.Credentials.from_service_account_file(
-            GOOGLE_APPLICATION_CREDENTIALS, scopes=SCOPES
-        )
+            # Ensure the environment variable is set
+            if "GOOGLE_APPLICATION_CREDENTIALS" not in os.environ:
+                raise ValueError(
+                    "Environment variable GOOGLE_APPLICATION_CREDENTIALS is not set."
+                )
 
-        # Use domain-wide delegation for GSuite/Google Workspace operations
-        delegated_credentials = credentials.with_subject(ADMIN_EMAIL)
+            # Load service account credentials
+            credentials = service_account.Credentials.from_service_account_file(
+                GOOGLE_APPLICATION_CREDENTIALS, scopes=SCOPES
+            )
 
-        # Build and return the service object for Google Admin SDK's Directory API
-        service = build(
-            "admin",
-            "directory_v1",
-            credentials=delegated_credentials,
-            cache_discovery=False,
-        )
-        logger.info("Successfully created new Google service object.")
-        return service
+            # Use domain-wide delegation for GSuite/Google Workspace operations
+            delegated_credentials = credentials.with_subject(ADMIN_EMAIL)
+
+            # Call the Directory API's REST endpoints directly over a pooled session. The
+            # access token is only refreshed once it has expired.
+            session = AuthorizedSession(delegated_credentials)
+            session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+            _service_singleton = session
+            logger.info("Successfully created new Google Directory API session.")
+            return _service_singleton
 
     except (
         ValueError,
@@ -94,10 +193,9 @@ def get_google_service():
         PermissionDenied,
         ServiceUnavailable,
         GoogleAPICallError,
-        HttpError,
         KeyError,
     ) as error:
-        logger.error("Error occurred during Google service creation: %s", error)
+        logger.error("Error occurred during Google session creation: %s", error)
         raise
 
 
@@ -114,19 +212,77 @@ def get_data_from_gcs():
     """
     Fetches user data from Google Cloud Storage (GCS).
 
+    The parsed data is kept in the request's cache, so repeated reads do not go
+    back to GCS. A blob fetched by an earlier request on this instance is reused
+    for GCS_CACHE_TTL_SECONDS. Such data may be stale, so callers that are going
+    to write should use reload_data_from_gcs() when _cache["from_snapshot"] is set.
+
     Returns:
         dict: The parsed JSON data as a dictionary, or an empty dictionary
               if the blob does not exist.
     """
-    bucket = storage_client.get_bucket(BUCKET_NAME)
-    blob = bucket.get_blob(FILE_NAME)
+    global _gcs_snapshot  # pylint: disable=global-statement
+
+    if _cache["data"] is None:
+        snapshot = _gcs_snapshot
+        from_snapshot = True
+        if snapshot is None or time.monotonic() - snapshot[0] >= GCS_CACHE_TTL_SECONDS:
+            bucket = storage_client.bucket(BUCKET_NAME)
+            blob = bucket.get_blob(FILE_NAME)
+            raw = download_blob_json(blob) if blob else b"{}"
+            # A generation of 0 makes the upload succeed only if the blob still doesn't exist.
+            snapshot = (time.monotonic(), raw, blob.generation if blob else 0)
+            _gcs_snapshot = snapshot
+            from_snapshot = False
+
+        _, raw, generation = snapshot
+        _cache.update(
+            {
+                "data": orjson.loads(raw),
+                "raw": raw,
+                "generation": generation,
+                "dirty": set(),
+                "from_snapshot": from_snapshot,
+            }
+        )
 
-    return json.loads(blob.download_as_text()) if blob else {}
+    return _cache["data"]
+
+
+def reload_data_from_gcs():
+    """
+    Discard the request's cached user data and the shared snapshot, and fetch the
+    user data from GCS again.
+
+    Returns:
+        dict: The freshly downloaded user data.
+    """
+    global _gcs_snapshot  # pylint: disable=global-statement
+
+    _gcs_snapshot = None
+    reset_data_cache()
+    return get_data_from_gcs()
+
+
+def download_blob_json(blob):
+    """
+    Download a blob's JSON content as bytes, decompressing it if it was stored gzipped.
+
+    The raw bytes are requested so decompression doesn't depend on whether GCS
+    transcodes the object. Blobs written before compression was added are returned
+    as is.
+    """
+    content = blob.download_as_bytes(raw_download=True)
+    if blob.content_encoding == "gzip":
+        return gzip.decompress(content)
+    return content
 
 
 def write_data_to_gcs(user_email, user_data):
     """
-    Writes or updates a user's data in Google Cloud Storage (GCS).
+    Writes or updates a user's data in the in-memory cache.
+
+    Nothing is sent to GCS until flush_data_to_gcs() is called.
 
     Args:
         user_email (str): Email address of the user.
@@ -135,47 +291,122 @@ def write_data_to_gcs(user_email, user_data):
     current_data = get_data_from_gcs()
     current_data[user_email] = current_data.get(user_email, {})
     current_data[user_email].update(user_data)
+    _cache["dirty"].add(user_email)
+
+
+def merge_with_latest_data():
+    """
+    Re-read user data from GCS and apply this request's changes on top of it.
+
+    Only the records of the users changed by this request are carried over. If
+    another request changed one of those records in the meantime, the changes
+    would conflict and PreconditionFailed is raised instead.
+    """
+    read_data = orjson.loads(_cache["raw"])
+    updates = {email: _cache["data"][email] for email in _cache["dirty"]}
 
-    bucket = storage_client.get_bucket(BUCKET_NAME)
+    latest_data = reload_data_from_gcs()
+
+    for email, user_data in updates.items():
+        if latest_data.get(email) != read_data.get(email):
+            raise PreconditionFailed(
+                f"User data for {email} was modified by another request."
+            )
+        latest_data[email] = user_data
+    _cache["dirty"] = set(updates)
+
+
+def flush_data_to_gcs():
+    """
+    Upload the cached user data to Google Cloud Storage (GCS) if it has changed.
+
+    The upload is conditional on the blob generation read by get_data_from_gcs(),
+    so a concurrent write is never overwritten. When only other users' records
+    changed, the upload is retried on top of the latest data.
+    """
+    global _gcs_snapshot  # pylint: disable=global-statement
+
+    if not _cache["dirty"]:
+        return
+
+    bucket = storage_client.bucket(BUCKET_NAME)
     blob = bucket.blob(FILE_NAME)
-    blob.upload_from_string(json.dumps(current_data))
+    # Store the blob gzipped, as the JSON is mostly repeated keys
+    blob.content_encoding = "gzip"
+
+    for attempt in range(1, GCS_WRITE_ATTEMPTS + 1):
+        payload = orjson.dumps(_cache["data"])
+        try:
+            blob.upload_from_string(
+                gzip.compress(payload),
+                content_type="application/json",
+                if_generation_match=_cache["generation"],
+            )
+            break
+        except PreconditionFailed:
+            if attempt == GCS_WRITE_ATTEMPTS:
+                raise
+            logger.warning("User data changed in GCS since it was read. Retrying.")
+            merge_with_latest_data()
+
+    _cache.update({"raw": payload, "generation": blob.generation, "dirty": set()})
+    _gcs_snapshot = (time.monotonic(), payload, blob.generation)
+
+
+def try_flush_data_to_gcs():
+    """
+    Flush the cached user data like flush_data_to_gcs(), but log a failure instead
+    of raising it.
+
+    Returns:
+        bool: True if the data was saved or nothing needed saving, False otherwise.
+    """
+    try:
+        flush_data_to_gcs()
+        return True
+    except (GoogleAPICallError, RetryError) as error:
+        logger.error("Failed to save user data to GCS: %s", error)
+        return False
+
+
+def reset_data_cache():
+    """Discard the request's cached user data so the next read loads it again."""
+    _cache.reset()
 
 
 def get_user_ou(service, user_email):
     """Retrieve the user's Organizational Unit within Google Workspace."""
     try:
-        user_info = service.users().get(userKey=user_email).execute()
-        return user_info.get("orgUnitPath", None)
-    except HttpError as http_error:
+        response = service.get(f"{DIRECTORY_USERS_URL}/{user_email}")
+        response.raise_for_status()
+        return response.json().get("orgUnitPath", None)
+    except RequestException as http_error:
         logger.error("Error retrieving OU: %s", str(http_error))
         return None
 
 
-def set_user_ou(service, user_email, target_ou):
-    """Set a new Organizational Unit for the user within Google Workspace."""
-
-    # Fetch current OU using get_user_ou
-    current_ou = get_user_ou(service, user_email)
+def set_user_ou(service, user_email, target_ou, current_ou=None):
+    """
+    Set a new Organizational Unit for the user within Google Workspace.
 
-    # If the current OU couldn't be fetched (e.g., due to an error), return False
-    if current_ou is None:
-        logger.error("Failed to fetch current OU for user: %s", user_email)
-        return False
+    If the caller passes the user's current_ou and it already matches target_ou,
+    no API call is made.
+    """
 
-    # If user is already in the desired OU, return True without making the update API call
     if current_ou == target_ou:
         logger.info("User is already in OU: %s. No changes needed.", target_ou)
         return True
 
-    # If user's current OU is different from target_ou, proceed with update
+    # Patch the OU directly; the request is idempotent if the user is already in target_ou
     try:
-        service.users().update(
-            userKey=user_email, body={"orgUnitPath": target_ou}
-        ).execute()
+        response = service.patch(
+            f"{DIRECTORY_USERS_URL}/{user_email}", json={"orgUnitPath": target_ou}
+        )
+        response.raise_for_status()
         logger.info("Successfully set OU to %s.", target_ou)
         return True
 
-    except HttpError as http_error:
+    except RequestException as http_error:
         logger.error("Failed to set OU to %s. Error: %s", target_ou, http_error)
     except (TypeError, AttributeError) as error:
         logger.error("Error setting OU: %s", error)
@@ -200,6 +431,7 @@ def initialize_user_data(user_email, current_date):
 
     # Get existing data or initialize with default values
     user_data = users_data.get(user_email)
+    is_dirty = False
 
     # If no data is found for the user, set up default values
     if not user_data:
@@ -209,20 +441,41 @@ def initialize_user_data(user_email, current_date):
             "ou_state": RESTRICTED_OU,
             "expiration_time_utc": None,
         }
+        is_dirty = True
 
     # If a day has passed, reset unrestricted switches
     elif user_data["last_request_date"] != current_date:
         user_data["unrestricted_switches"] = 0
         user_data["last_request_date"] = current_date
+        is_dirty = True
 
-    write_data_to_gcs(user_email, user_data)
+    # Only write when the user's data actually changed
+    if is_dirty:
+        write_data_to_gcs(user_email, user_data)
     return user_data
 
 
+def to_epoch(utc_datetime):
+    """Convert a naive UTC datetime to an integer Unix epoch."""
+    return int(utc_datetime.replace(tzinfo=timezone.utc).timestamp())
+
+
+def get_expiration_epoch(user_data):
+    """
+    Return the user's expiration time as an integer Unix epoch, or None if not set.
+
+    Records written by earlier versions store the expiration time as an ISO string.
+    """
+    expiration_time_utc = user_data.get("expiration_time_utc")
+    if isinstance(expiration_time_utc, str):
+        return to_epoch(datetime.fromisoformat(expiration_time_utc))
+    return expiration_time_utc
+
+
 def hours_until_midnight():
     """Returns the number of hours until midnight."""
     now = datetime.now()
-    difference = datetime.combine(now + timedelta(days=1), time()) - now
+    difference = datetime.combine(now + timedelta(days=1), datetime.min.time()) - now
     return difference.seconds // 3600
 
 
@@ -233,20 +486,58 @@ def has_exceeded_switch_limit(user_data):
     return False
 
 
-def move_user_to_restricted_on_expiry(service, user_data, response_content):
+# Scenarios in which toggle_access only reads the user's data
+READ_ONLY_SCENARIOS = {
+    "switch_limit_exceeded",
+    "user_in_unrestricted_valid_time_remaining",
+}
+
+
+def select_toggle_scenario(user_data, now):
+    """
+    Decide how toggle_access should handle the request.
+
+    Args:
+        user_data (dict): The user's data including their current OU state and expiration times.
+        now (int): The current time as a Unix epoch.
+
+    Returns:
+        str: The scenario name. Scenarios in READ_ONLY_SCENARIOS don't change any data.
+    """
+    if has_exceeded_switch_limit(user_data):
+        return "switch_limit_exceeded"
+
+    if user_data.get("ou_state", RESTRICTED_OU) != UNRESTRICTED_OU:
+        return "user_in_restricted_moving_to_unrestricted"
+
+    expiration_time_utc = get_expiration_epoch(user_data)
+    if expiration_time_utc is None:
+        return "user_in_unrestricted_without_expiration"
+    if now > expiration_time_utc:
+        return "user_in_unrestricted_expired_time"
+    return "user_in_unrestricted_valid_time_remaining"
+
+
+def move_user_to_restricted_on_expiry(
+    service, user_data, response_content, current_ou=None
+):
     """
     Handle the scenario where the user is in the UNRESTRICTED_OU but the expiration time has passed.
     The user will be moved to the RESTRICTED_OU.
 
     Args:
-        service (obj): The Google service object.
+        service (obj): The authorized Directory API session.
         user_data (dict): The user's data including their current OU state and expiration times.
         response_content (dict): The default response setup to be updated.
+        current_ou (str): The user's actual OU, if known. Defaults to the cached OU state.
 
     Returns:
         tuple: Updated response_content dictionary, an HTTP status code, and the updated user_data.
     """
-    if not set_user_ou(service, USER_EMAIL, RESTRICTED_OU):
+    if current_ou is None:
+        current_ou = user_data.get("ou_state")
+
+    if not set_user_ou(service, USER_EMAIL, RESTRICTED_OU, current_ou):
         response_content.update(
             {
                 "user_message": "Failed to set OU",
@@ -276,17 +567,16 @@ def inform_remaining_time_in_unrestricted(
     Inform the user about the remaining time they have in the UNRESTRICTED_OU.
 
     Args:
-        expiration_time_utc_in_cache (str): The expiration time for the user's access in ISO format.
+        expiration_time_utc_in_cache (int): The expiration time for the user's access,
+            as a Unix epoch.
         user_data (dict): The user's data including their current switch count.
         response_content (dict): The default response setup to be updated.
 
     Returns:
         tuple: Updated response_content dictionary and an HTTP status code.
     """
-    remaining_time = (
-        datetime.fromisoformat(expiration_time_utc_in_cache) - datetime.utcnow()
-    )
-    hours, remainder = divmod(remaining_time.seconds, 3600)
+    remaining_seconds = max(expiration_time_utc_in_cache - int(time.time()), 0)
+    hours, remainder = divmod(remaining_seconds, 3600)
     minutes = remainder // 60
 
     # Create a list of time components and filter out zero values
@@ -318,7 +608,7 @@ def transfer_user_to_unrestricted_ou(service, user_data, response_content):
     Transfer the user from the RESTRICTED_OU to the UNRESTRICTED_OU and update the expiration time.
 
     Args:
-        service (obj): The Google service object.
+        service (obj): The authorized Directory API session.
         user_data (dict): The user's data including their current OU state and expiration times.
         response_content (dict): The default response setup to be updated.
 
@@ -327,7 +617,9 @@ def transfer_user_to_unrestricted_ou(service, user_data, response_content):
     """
 
     # Attempt to set user OU
-    if not set_user_ou(service, USER_EMAIL, UNRESTRICTED_OU):
+    if not set_user_ou(
+        service, USER_EMAIL, UNRESTRICTED_OU, user_data.get("ou_state")
+    ):
         response_content.update(
             {
                 "user_message": (
@@ -339,39 +631,29 @@ def transfer_user_to_unrestricted_ou(service, user_data, response_content):
         )
         return response_content, 503, user_data
 
-    # Update user's switch count
-    user_data["unrestricted_switches"] += 1
-    write_data_to_gcs(USER_EMAIL, user_data)
-
-    # Schedule revert job
-    expiration_time_utc = schedule_revert_job()
-    if not expiration_time_utc:
-        response_content.update(
-            {
-                "user_message": (
-                    "We encountered an issue scheduling your unrestricted time. "
-                    "Please try again later."
-                ),
-                "error": "Service Unavailable",
-            }
-        )
-        return response_content, 503, user_data
-
-    # Update user_data with the new expiration time and OU state
+    # Persist the new switch count, expiration time and OU state in a single write
+    scheduled_time = next_revert_time()
     user_data.update(
         {
-            "expiration_time_utc": expiration_time_utc.isoformat(),
+            "unrestricted_switches": user_data["unrestricted_switches"] + 1,
             "ou_state": UNRESTRICTED_OU,
+            "expiration_time_utc": to_epoch(scheduled_time),
         }
     )
     write_data_to_gcs(USER_EMAIL, user_data)
 
+    # The response doesn't depend on the revert job, so schedule it in the background.
+    # Failed attempts are retried, but if they all fail nothing will revert the user
+    # automatically, so that case is logged as an error.
+    future = _background_pool.submit(schedule_revert_job_with_retries, scheduled_time)
+    future.add_done_callback(log_background_error)
+
     # Construct success response
     remaining_switches = UNRESTRICTED_SWITCH_LIMIT - user_data["unrestricted_switches"]
     times_word = "time" if remaining_switches == 1 else "times"
     user_message = (
         f"You've been moved to unrestricted mode and will be reverted "
-        f"after {DURATION_MINUTES} minutes. You can switch to unrestricted mode "
+        f"after {_DURATION_PHRASE}. You can switch to unrestricted mode "
         f"{remaining_switches} more {times_word} today."
     )
     response_content.update({"success": True, "user_message": user_message})
@@ -379,7 +661,7 @@ def transfer_user_to_unrestricted_ou(service, user_data, response_content):
     return response_content, 200, user_data
 
 
-def toggle_access(request):  # pylint: disable=too-many-return-statements
+def toggle_access(request):
     """
     Handle access toggling for a user based on the incoming request.
 
@@ -398,89 +680,76 @@ def toggle_access(request):  # pylint: disable=too-many-return-statements
     }
     http_status = 500
 
+    # Reject unauthorized requests before doing any I/O
+    if not check_api_key(request):
+        response_content.update(
+            {"user_message": "Unauthorized", "error": "Unauthorized"}
+        )
+        http_status = 401
+        return jsonify(**response_content), http_status
+
+    reset_data_cache()
+    now = int(time.time())
     current_date = datetime.now().date().isoformat()
     user_data = initialize_user_data(USER_EMAIL, current_date)
-    write_data_to_gcs(USER_EMAIL, user_data)
+    scenario = select_toggle_scenario(user_data, now)
 
-    if has_exceeded_switch_limit(user_data):
+    # Data from the shared snapshot may be stale and would make the final write fail,
+    # after the OU has already changed. Only answer from it when nothing is written.
+    if _cache["from_snapshot"] and (
+        _cache["dirty"] or scenario not in READ_ONLY_SCENARIOS
+    ):
+        reload_data_from_gcs()
+        user_data = initialize_user_data(USER_EMAIL, current_date)
+        scenario = select_toggle_scenario(user_data, now)
+
+    expiration_time_utc_in_cache = get_expiration_epoch(user_data)
+    logging.info("%s: expiration_time: %s", scenario, expiration_time_utc_in_cache)
+
+    if scenario == "switch_limit_exceeded":
         hours_remaining = hours_until_midnight()
         hours_phrase = "hour" if hours_remaining == 1 else "hours"
-        switches_phrase = "switch" if UNRESTRICTED_SWITCH_LIMIT == 1 else "switches"
 
         response_content.update(
             {
                 "user_message": (
-                    f"You've reached the maximum of {UNRESTRICTED_SWITCH_LIMIT} {switches_phrase} "
-                    f"into a less restrictive organizational unit today. "
-                    f"Try again in {hours_remaining} {hours_phrase}."
+                    f"{_LIMIT_PREFIX} Try again in {hours_remaining} {hours_phrase}."
                 ),
                 "error": "Switch limit exceeded",
             }
         )
         http_status = 403
-        return jsonify(**response_content), http_status
+        return respond_after_saving_user_data(response_content, http_status)
 
     try:
-        if not check_api_key(request):
-            response_content.update(
-                {"user_message": "Unauthorized", "error": "Unauthorized"}
-            )
-            http_status = 401
-            return jsonify(**response_content), http_status
-
         service = get_google_service()
-        current_ou = get_user_ou(service, USER_EMAIL)
-        expiration_time_utc_in_cache = user_data.get("expiration_time_utc", None)
-
-        if current_ou == UNRESTRICTED_OU:
-            # Scenario 1: User in UNRESTRICTED_OU but no expiration time
-            if expiration_time_utc_in_cache is None:
-                logging.info("user_in_unrestricted_without_expiration.")
-                (
-                    response_content,
-                    http_status,
-                    user_data,
-                ) = move_user_to_restricted_on_expiry(
-                    service, user_data, response_content
-                )
-                return jsonify(**response_content), http_status
 
-            # Scenario 2: User in UNRESTRICTED_OU with expired time
-            if datetime.utcnow().isoformat() > expiration_time_utc_in_cache:
-                logging.info(
-                    "user_in_unrestricted_expired_time: expiration_time: %s",
-                    expiration_time_utc_in_cache,
-                )
-                (
-                    response_content,
-                    http_status,
-                    user_data,
-                ) = move_user_to_restricted_on_expiry(
-                    service, user_data, response_content
-                )
-                return jsonify(**response_content), http_status
-
-            # Scenario 3: User in UNRESTRICTED_OU with valid time remaining
-            if datetime.utcnow().isoformat() <= expiration_time_utc_in_cache:
-                logging.info(
-                    "user_in_unrestricted_valid_time_remaining: expiration_time: %s",
-                    expiration_time_utc_in_cache,
-                )
-                response_content, http_status = inform_remaining_time_in_unrestricted(
-                    expiration_time_utc_in_cache, user_data, response_content
-                )
-                return jsonify(**response_content), http_status
+        # Scenarios 1 and 2: User in UNRESTRICTED_OU without an expiration time, or
+        # with an expired one. The user will be moved to the RESTRICTED_OU.
+        if scenario in (
+            "user_in_unrestricted_without_expiration",
+            "user_in_unrestricted_expired_time",
+        ):
+            (
+                response_content,
+                http_status,
+                user_data,
+            ) = move_user_to_restricted_on_expiry(service, user_data, response_content)
+
+        # Scenario 3: User in UNRESTRICTED_OU with valid time remaining
+        elif scenario == "user_in_unrestricted_valid_time_remaining":
+            response_content, http_status = inform_remaining_time_in_unrestricted(
+                expiration_time_utc_in_cache, user_data, response_content
+            )
 
         # Scenario 4: User is in the restricted OU and needs to be moved to the unrestricted OU.
         else:
-            logging.info("user_in_restricted_moving_to_unrestricted.")
             response_content, http_status, user_data = transfer_user_to_unrestricted_ou(
                 service, user_data, response_content
             )
-            return jsonify(**response_content), http_status
 
     except (
-        HttpError,
+        RequestException,
         GoogleAPICallError,
         RetryError,
         NotFound,
@@ -489,86 +758,160 @@ def toggle_access(request):  # pylint: disable=too-many-return-statements
     ) as google_api_error:
         logger.error("Google API error: %s", str(google_api_error))
         response_content.update(
-            {"user_message": "Google API error", "error": "Google API error"}
+            {
+                "success": False,
+                "user_message": "Google API error",
+                "error": "Google API error",
+            }
         )
         http_status = 503
+        return jsonify(**response_content), http_status
+
+    return respond_after_saving_user_data(response_content, http_status)
+
+
+def respond_after_saving_user_data(response_content, http_status):
+    """
+    Save the request's user data changes to GCS and build the toggle_access response.
 
+    If saving fails, the response reports the failure instead. Any OU change has
+    already been applied by then, but it isn't recorded in the user data.
+
+    Args:
+        response_content (dict): The response built for the request.
+        http_status (int): The HTTP status code for the response.
+
+    Returns:
+        tuple: The JSON response and an HTTP status code.
+    """
+    if not try_flush_data_to_gcs():
+        response_content.update(
+            {
+                "success": False,
+                "user_message": (
+                    "Your access was changed, but we couldn't record the change. "
+                    "Please try again later."
+                ),
+                "error": "Service Unavailable",
+            }
+        )
+        http_status = 503
     return jsonify(**response_content), http_status
 
 
+def log_background_error(future):
+    """Log an exception raised by a task run on _background_pool, which would otherwise be lost."""
+    error = future.exception()
+    if error is not None:
+        logger.error("Background task failed: %s", error, exc_info=error)
+
+
 # Scheduler Functions
-def get_job_name(user_email):
-    """Return the job name based on USER_EMAIL."""
-    sanitized_email = user_email.replace("@", "_").replace(".", "_")
-    return (
-        f"projects/{PROJECT_ID}/locations/{LOCATION}/jobs/{sanitized_email}_revert_ou"
-    )
+def next_revert_time():
+    """
+    Return when a revert job created now should run, as a naive UTC datetime.
 
+    The time is DURATION_MINUTES from now, rounded up to the next minute for buffer.
+    We do this because Google Cloud Scheduler only runs by the minute, not to the second.
+    """
+    scheduled_time = datetime.utcnow() + timedelta(minutes=DURATION_MINUTES)
+    return scheduled_time.replace(second=0, microsecond=0) + timedelta(minutes=1)
 
-def schedule_revert_job():
-    """Schedule a job to revert the OU after DURATION_MINUTES and update the cache."""
 
-    client = scheduler_v1.CloudSchedulerClient()
+def schedule_revert_job(scheduled_time):
+    """
+    Schedule a job to revert the OU at scheduled_time.
 
-    # Calculate when the next job should run and adjust scheduled_time to round up
-    # to the nearest minute for buffer. We do this because Google Cloud Scheduler
-    # only runs by the minute, not to the second.
-    scheduled_time = datetime.utcnow() + timedelta(minutes=DURATION_MINUTES)
-    scheduled_time = scheduled_time.replace(second=0, microsecond=0) + timedelta(
-        minutes=1
-    )
+    Args:
+        scheduled_time (datetime): When the job should run, as a naive UTC datetime.
 
-    try:
-        existing_job = client.get_job(name=get_job_name(USER_EMAIL))
-        cron_schedule_str = existing_job.schedule
-        cron_iter = croniter(cron_schedule_str, datetime.utcnow())
-        existing_scheduled_time = cron_iter.get_next(datetime)
-
-        # If the existing job runs after the duration, delete it
-        time_difference = (
-            existing_scheduled_time - datetime.utcnow()
-        ).total_seconds() / 60
-        if time_difference > DURATION_MINUTES:
-            delete_scheduler_job(USER_EMAIL)
-            # We don't return after deleting. We let it proceed to create a new job.
-        else:
-            logger.info(
-                "Revert job for user already exists and is scheduled to run at %s. Job name: %s.",
-                existing_scheduled_time,
-                existing_job.name,
-            )
-            return existing_scheduled_time
-    except NotFound:
-        pass  # Continue to create a new job if no existing job or if the previous one was deleted
+    Returns:
+        int: When the revert job will run, as a Unix epoch, or None if scheduling failed.
+    """
+
+    client = scheduler_v1.CloudSchedulerClient()
 
     # Set up HTTP target and cron schedule
     http_target = {
         "uri": f"https://{LOCATION}-{PROJECT_ID}.cloudfunctions.net/cron_revert_ou",
         "http_method": scheduler_v1.HttpMethod.POST,
         "headers": {"Content-Type": "application/json"},
-        "body": json.dumps({"email": USER_EMAIL}).encode("utf-8"),
+        "body": REVERT_JOB_BODY,
     }
     cron_schedule = f"{scheduled_time.minute} {scheduled_time.hour} * * *"
     job = {
-        "name": get_job_name(USER_EMAIL),
+        "name": JOB_NAME,
         "http_target": http_target,
         "schedule": cron_schedule,
     }
 
+    # Try to create the job first, as there's usually no existing job
     try:
-        response = client.create_job(
-            parent=f"projects/{PROJECT_ID}/locations/{LOCATION}", job=job
-        )
+        response = client.create_job(parent=PARENT_PATH, job=job)
         logger.info(
             "Scheduled new revert job for user at %s. Job name: %s.",
             scheduled_time,
             response.name,
         )
-        return scheduled_time
+        return to_epoch(scheduled_time)
+    except AlreadyExists:
+        pass  # Continue to reschedule the existing job
     except (GoogleAPICallError, RetryError) as error:
         logger.error("Failed to schedule a new revert job for user. Error: %s.", error)
         return None
 
+    # Move the existing job to scheduled_time so it matches the stored expiration time
+    try:
+        response = client.update_job(job=job)
+        logger.info(
+            "Rescheduled revert job for user to %s. Job name: %s.",
+            scheduled_time,
+            response.name,
+        )
+        return to_epoch(scheduled_time)
+    except (GoogleAPICallError, RetryError) as error:
+        logger.error("Failed to reschedule the revert job for user. Error: %s.", error)
+        return None
+
+
+def schedule_revert_job_with_retries(scheduled_time):
+    """
+    Schedule the revert job like schedule_revert_job(), retrying with exponential
+    backoff. Meant to run on _background_pool.
+
+    Args:
+        scheduled_time (datetime): When the job should run, as a naive UTC datetime.
+
+    Returns:
+        int: When the revert job will run, as a Unix epoch, or None if every attempt failed.
+    """
+    delay = REVERT_JOB_RETRY_DELAY_SECONDS
+    for attempt in range(1, REVERT_JOB_ATTEMPTS + 1):
+        try:
+            expiration_time_utc = schedule_revert_job(scheduled_time)
+            if expiration_time_utc is not None:
+                return expiration_time_utc
+        except Exception as error:  # pylint: disable=broad-except
+            logger.warning("Error scheduling the revert job: %s", error)
+
+        if attempt < REVERT_JOB_ATTEMPTS:
+            logger.warning(
+                "Retrying revert job scheduling in %s seconds (attempt %s of %s).",
+                delay,
+                attempt,
+                REVERT_JOB_ATTEMPTS,
+            )
+            time.sleep(delay)
+            delay *= 2
+
+    logger.error(
+        "Gave up scheduling the revert job after %s attempts. The user will stay in "
+        "%s until moved back manually.",
+        REVERT_JOB_ATTEMPTS,
+        UNRESTRICTED_OU,
+    )
+    return None
+
 
 def cron_revert_ou(request):
     """Revert the Organizational Unit (OU) for a user whose unrestricted time has expired."""
@@ -578,34 +921,42 @@ def cron_revert_ou(request):
         logging.error("Function called with wrong HTTP method: %s", request.method)
         return jsonify(error="This function expects a POST request"), 405
 
-    # Initialize service and fetch user data
+    # Initialize service and fetch user data. Always read a fresh copy, as this
+    # handler usually writes.
     service = get_google_service()
-    users_data = get_data_from_gcs()
+    users_data = reload_data_from_gcs()
     user_data = users_data.get(USER_EMAIL)
-    current_ou = get_user_ou(service, USER_EMAIL)
+
+    # The cached state decides for a user we moved to UNRESTRICTED_OU. Only ask the
+    # Directory API otherwise, to catch a user moved there outside of this app.
+    current_ou = None
+    if user_data.get("ou_state") != UNRESTRICTED_OU:
+        current_ou = get_user_ou(service, USER_EMAIL)
 
     # Check conditions for reverting OU
     if (
         user_data.get("ou_state") == UNRESTRICTED_OU
-        and datetime.utcnow().isoformat() >= user_data.get("expiration_time_utc")
+        and int(time.time()) >= get_expiration_epoch(user_data)
     ) or (
         current_ou == UNRESTRICTED_OU and user_data.get("ou_state") != UNRESTRICTED_OU
     ):
         logging.info("Condition met to revert OU.")
         response_content, http_status, user_data = move_user_to_restricted_on_expiry(
-            service, user_data, {}
+            service, user_data, {}, current_ou
         )
         if http_status == 200:
-            delete_scheduler_job(USER_EMAIL)
+            delete_scheduler_job()
             message = "Successfully reverted OU for user."
             logging.info(message)
         else:
             error_msg = (
                 f"Error processing user. Expected OU (from local cache): "
-                f"{user_data.get('ou_state')}, Actual OU (from Google service): {current_ou}. "
+                f"{user_data.get('ou_state')}, "
+                f"Actual OU (from Google service): {current_ou or 'not checked'}. "
                 f"Error message: {response_content['user_message']}"
             )
             logging.error(error_msg)
+            try_flush_data_to_gcs()
             return jsonify(error=response_content["user_message"]), http_status
     else:
         message = (
@@ -621,19 +972,20 @@ def cron_revert_ou(request):
         user_data["last_request_date"] = current_date
         write_data_to_gcs(USER_EMAIL, user_data)
 
+    if not try_flush_data_to_gcs():
+        return jsonify(error="Failed to save user data"), 503
     return (
         jsonify(success=user_data.get("ou_state") == RESTRICTED_OU, message=message),
         200,
     )
 
 
-def delete_scheduler_job(user_email):
-    """Delete a Cloud Scheduler job."""
+def delete_scheduler_job():
+    """Delete the Cloud Scheduler revert job for USER_EMAIL."""
     client = scheduler_v1.CloudSchedulerClient()
-    job_name = get_job_name(user_email)
 
     try:
-        client.delete_job(name=job_name)
+        client.delete_job(name=JOB_NAME)
         logger.info("Successfully deleted Cloud Scheduler job.")
     except NotFound:
         pass